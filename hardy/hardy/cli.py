@@ -1,18 +1,19 @@
 import sys
 from bisect import bisect_left
+from hashlib import sha256
 from io import StringIO
 from itertools import product
 from pathlib import Path
 from pprint import pprint
-from random import seed, shuffle
 from textwrap import dedent
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
 import yaml
 from click import Path as ClickPath
-from click import File, group, option, version_option
+from click import File, FloatRange, group, option, version_option
 from plotly.colors import (
     PLOTLY_SCALES,
     colorscale_to_colors,
@@ -24,6 +25,8 @@ from plotly.colors import (
 from plotly.offline import plot
 from sample_sheet import SampleSheet, Sample
 
+from hardy.runs import is_measurement
+
 
 __version__ = "0.0.0"
 
@@ -43,8 +46,8 @@ def load_data(input):
         raise ValueError("Input must be .tsv, .csv, .xls, or .xlsx")
 
 
-def load_template_protocol():
-    template_path = Path(__file__).resolve().parent / "template-protocol.py"
+def load_template_protocol(filename="template-protocol.py"):
+    template_path = Path(__file__).resolve().parent / filename
     with open(template_path, "r") as ip:
         return ip.read()
 
@@ -62,6 +65,25 @@ def instantiate_template_protocol(df, output_path):
         print(load_template_protocol().format(buf.getvalue()), file=op)
 
 
+def instantiate_redilution_protocol(df, output_path):
+    with open(output_path, "w") as op:
+        cols = [
+            "redil_flag",
+            "redil_parent",
+            "source_well",
+            "redil_well",
+            "dest_well",
+            "redil_factor",
+            "redil_sample_vol_ul",
+            "redil_diluent_vol_ul",
+            "redil_transfer_vol_ul",
+        ]
+        buf = StringIO()
+        df.to_csv(buf, columns=cols, sep="\t", index=False, float_format="%.3f")
+        template = load_template_protocol("template-redilution-protocol.py")
+        print(template.format(buf.getvalue()), file=op)
+
+
 def validate_data(df):
     reqd_cols = ["library_id", "sample_id", "source_well", "conc_ug_ml"]
     if not (set(reqd_cols) <= set(df.columns)):
@@ -85,11 +107,154 @@ def validate_data(df):
         raise ValueError("Each row must have a unique library_id")
 
 
-def set_seed(df):
-    seed("".join(df["library_id"][df["library_id"].notnull()]))
+def layout_seed(df):
+    library_ids = "".join(df["library_id"][df["library_id"].notnull()])
+    return int.from_bytes(sha256(library_ids.encode()).digest()[:8], "big")
+
+
+def is_control(value):
+    """True/1/"true"/"yes" mark a control serum; anything else does not"""
+    if isinstance(value, str):
+        return value.strip().lower() in ["true", "yes", "1"]
+    return bool(value is True or value == 1)
+
+
+def layout_groups(df):
+    """Label each well with the group that should be spread over the plate
+
+    Bead-only controls (library without a concentration) and control sera
+    (marked in the optional `control` column) form their own groups; the rest
+    are grouped by the optional `project` column.  Wells without a library are
+    unconstrained (None).
+    """
+    if "project" in df.columns:
+        groups = df["project"].fillna("sample").astype(str)
+    else:
+        groups = pd.Series("sample", index=df.index)
+    if "control" in df.columns:
+        groups = groups.where(~df["control"].map(is_control), "control")
+    groups = groups.where(df["conc_ug_ml"].notnull(), "beads")
+    return groups.where(df["library_id"].notnull(), None)
+
+
+CONTROL_GROUPS = ["beads", "control"]
+CONTROL_WEIGHT = 4.0
+
+
+def expected_group_scores(size):
+    """Expected row/column imbalance and adjacent pairs under random placement
+
+    Row and column counts of a group of `size` wells are hypergeometric, so
+    their expected squared deviation from an even spread is the variance.
+    """
+    spread = size * (96 - size) / 95
+    row_imbalance = 8 * spread * (12 / 96) * (84 / 96)
+    col_imbalance = 12 * spread * (8 / 96) * (88 / 96)
+    adjacent_pairs = (8 * 11 + 7 * 12) * size * (size - 1) / (96 * 95)
+    return row_imbalance + col_imbalance + adjacent_pairs
+
+
+def score_layouts(codes, weights, wells):
+    """Score candidate plate layouts against the balance constraints
+
+    `codes` is the group code of each sample (-1 for unconstrained wells),
+    `weights` the weight of each group and `wells` a (candidates, samples)
+    array of destination well indices into `all_wells()`.  Each group's score
+    is taken relative to its expected value under random placement (so
+    `vs_random` < 1 beats a plain shuffle), and the candidate score is the
+    weighted sum over groups; lower is better.
+    """
+    num_candidates = wells.shape[0]
+    num_groups = len(weights)
+    constrained = codes >= 0
+    codes, wells = codes[constrained], wells[:, constrained]
+    sizes = np.bincount(codes, minlength=num_groups)
+    candidates = np.arange(num_candidates)[:, None]
+
+    def count(keys, num_keys):
+        # occurrences of each (candidate, group, key) for all groups at once
+        flat = ((candidates * num_groups + codes) * num_keys + keys).ravel()
+        counts = np.bincount(flat, minlength=num_candidates * num_groups * num_keys)
+        return counts.reshape(num_candidates, num_groups, num_keys)
+
+    # squared deviation of row/column counts from an even spread
+    rows = count(wells // 12, 8)
+    cols = count(wells % 12, 12)
+    row_imbalance = ((rows - sizes[:, None] / 8) ** 2).sum(axis=2)
+    col_imbalance = ((cols - sizes[:, None] / 12) ** 2).sum(axis=2)
+
+    # orthogonally adjacent wells from the same group
+    plate = np.full((num_candidates, 96), -1)
+    plate[candidates, wells] = codes
+    plate = plate.reshape(num_candidates, 8, 12)
+    horizontal = np.where(plate[:, :, 1:] == plate[:, :, :-1], plate[:, :, 1:], -1)
+    vertical = np.where(plate[:, 1:, :] == plate[:, :-1, :], plate[:, 1:, :], -1)
+    pairs = np.concatenate(
+        [horizontal.reshape(num_candidates, -1), vertical.reshape(num_candidates, -1)],
+        axis=1,
+    )
+    same_group = pairs >= 0
+    flat = (np.broadcast_to(candidates, pairs.shape) * num_groups + pairs)[same_group]
+    adjacent_pairs = np.bincount(
+        flat, minlength=num_candidates * num_groups
+    ).reshape(num_candidates, num_groups)
+
+    raw = row_imbalance + col_imbalance + adjacent_pairs
+    vs_random = raw / expected_group_scores(sizes)
+    return {
+        "score": vs_random @ np.asarray(weights, dtype=float),
+        "row_imbalance": row_imbalance,
+        "col_imbalance": col_imbalance,
+        "adjacent_pairs": adjacent_pairs,
+        "vs_random": vs_random,
+    }
+
+
+def group_weights(groups):
+    return [CONTROL_WEIGHT if group in CONTROL_GROUPS else 1.0 for group in groups]
 
 
-def summarize_output(df):
+def constrained_layout(df, num_candidates=16384, shortlist=0.05, chunk_size=1024):
+    """Deterministically pick the best-balanced of many random layouts
+
+    Candidates are first shortlisted on their worst group (so every group is
+    spread better than random), then ranked on the weighted score.
+    """
+    codes, groups = pd.factorize(layout_groups(df))
+    rng = np.random.default_rng(layout_seed(df))  # ensures deterministic shuffling
+    wells = np.argsort(rng.random((num_candidates, 96)), axis=1)[:, : len(df)]
+
+    # score in chunks of candidates to bound memory with many groups
+    weights = group_weights(groups)
+    chunks = [
+        score_layouts(codes, weights, chunk)
+        for chunk in np.array_split(wells, max(1, num_candidates // chunk_size))
+    ]
+    score = np.concatenate([chunk["score"] for chunk in chunks])
+    vs_random = np.concatenate([chunk["vs_random"] for chunk in chunks])
+
+    worst_group = vs_random.max(axis=1, initial=0)
+    shortlisted = worst_group <= np.quantile(worst_group, shortlist)
+    best = np.where(shortlisted, score, np.inf).argmin()
+    return [all_wells()[i] for i in wells[best]]
+
+
+def summarize_layout(df):
+    codes, groups = pd.factorize(layout_groups(df))
+    wells = np.array([[all_wells().index(well) for well in df["dest_well"]]])
+    scores = score_layouts(codes, group_weights(groups), wells)
+    per_group = ["row_imbalance", "col_imbalance", "adjacent_pairs", "vs_random"]
+    return {
+        "score": scores["score"][0].tolist(),
+        "groups": {
+            group: {name: scores[name][0, code].tolist() for name in per_group}
+            for (code, group) in enumerate(groups)
+        },
+    }
+
+
+def summarize_output(df, redilution):
+    rescued = redilution["redil_flag"] == "valid"
     summary = {
         "median_valid_transfer_vol_ul": df.loc[
             df["norm_flag"] == "valid", "transfer_vol_ul"
@@ -101,6 +266,10 @@ def summarize_output(df):
         "num_too_concentrated": (df["norm_flag"] == "too_concentrated").sum().tolist(),
         "num_empty": (df["norm_flag"] == "empty").sum().tolist(),
         "num_weird": (df["norm_flag"] == "weird").sum().tolist(),
+        "num_rescued": rescued.sum().tolist(),
+        "num_rediluted": (rescued & (redilution["redil_factor"] > 1)).sum().tolist(),
+        "num_unrescuable": (redilution["redil_flag"] == "unrescuable").sum().tolist(),
+        "layout": summarize_layout(df),
     }
     pprint(summary, stream=sys.stderr)
     return summary
@@ -129,16 +298,84 @@ def compute_normalization(df, transfer_mass_ug, min_volume, max_volume, shuffle_
             raise ValueError(
                 "When shuffling wells, input cannot already have barcode associations"
             )
-        set_seed(df)  # ensures deterministic shuffling
-        shuffled_wells = all_wells()
-        shuffle(shuffled_wells)
-        df["dest_well"] = shuffled_wells
+        df["dest_well"] = constrained_layout(df)
     else:
         df["dest_well"] = df["source_well"]
 
     return df
 
 
+def compute_redilution(df, min_volume, max_volume, stock_dilution, well_capacity=1000):
+    """Plan the dilutions that bring out-of-range wells inside the volume range
+
+    Too-concentrated wells are diluted from the source plate into an
+    intermediate plate (well `redil_well`).  Too-dilute wells are drawn from a
+    stock plate laid out like the source plate but `stock_dilution` times more
+    concentrated, and diluted further if needed.  Diluted wells end up
+    transferring the geometric middle of [min_volume, max_volume].  Wells that
+    still cannot be transferred are flagged "unrescuable".
+    """
+    if stock_dilution is not None and not stock_dilution > 1:
+        raise ValueError("stock_dilution must be greater than 1")
+    out_of_range = df["norm_flag"].isin(["too_dilute", "too_concentrated"])
+    df = df[out_of_range].copy()
+    too_dilute = df["norm_flag"] == "too_dilute"
+
+    # volume that would be transferred straight from the parent plate
+    df["redil_parent"] = "source_plate"
+    df.loc[too_dilute, "redil_parent"] = "stock_plate"
+    parent_vol = df["transfer_vol_ul"].copy()
+    if stock_dilution is not None:
+        parent_vol[too_dilute] = parent_vol[too_dilute] / stock_dilution
+
+    target_vol = (min_volume * max_volume) ** 0.5
+    needs_dilution = parent_vol < min_volume
+    df["redil_factor"] = (target_vol / parent_vol).where(needs_dilution, 1.0)
+    # enough sample for twice the transfer, with pipettable sample and diluent
+    sample_vol = np.maximum(min_volume, 2 * parent_vol)
+    sample_vol = np.maximum(sample_vol, min_volume / (df["redil_factor"] - 1))
+    df["redil_sample_vol_ul"] = sample_vol.where(needs_dilution, 0.0)
+    df["redil_diluent_vol_ul"] = df["redil_sample_vol_ul"] * (df["redil_factor"] - 1)
+    df["redil_transfer_vol_ul"] = parent_vol * df["redil_factor"]
+    df["redil_well"] = df["dest_well"]
+
+    # too-dilute wells stay above max_volume when there is no stock plate, and
+    # zero/negative concentrations cannot be planned at all
+    unrescuable = (
+        (df["redil_transfer_vol_ul"] > max_volume)
+        | (df["redil_sample_vol_ul"] * df["redil_factor"] > well_capacity)
+        | ~np.isfinite(parent_vol)
+        | (parent_vol <= 0)
+    )
+    df["redil_flag"] = "valid"
+    df.loc[unrescuable, "redil_flag"] = "unrescuable"
+    plan_cols = [
+        "redil_factor",
+        "redil_sample_vol_ul",
+        "redil_diluent_vol_ul",
+        "redil_transfer_vol_ul",
+    ]
+    df.loc[unrescuable, plan_cols] = np.nan
+
+    return df
+
+
+def write_plate_table(df, output_path, run):
+    """Write the plate table as Parquet, tagged with the run it came from
+
+    Measurements are stored as float64 and every other column (including
+    optional ones that may be blank or mixed) as strings, so tables from many
+    runs share a schema (see `hardy.runs`).
+    """
+    df = df.assign(run=run)
+    for col in df.columns:
+        if is_measurement(col):
+            df[col] = df[col].astype("float64")
+        else:
+            df[col] = df[col].astype("string")
+    df.to_parquet(output_path, index=False)
+
+
 def attach_barcodes(df, barcodes_file):
     barcodes = load_data(barcodes_file)
     if len({"plate_well", "bc_read"} - set(barcodes.columns)) > 0:
@@ -258,7 +495,14 @@ def cli():
 
 
 @cli.command(name="phip-norm")
-@option("-i", "--input", type=File("rb"), required=True, help="min cols: library_id,sample_id,source_well,conc_ug_ml")
+@option(
+    "-i",
+    "--input",
+    type=File("rb"),
+    required=True,
+    help="min cols: library_id,sample_id,source_well,conc_ug_ml; optional "
+    "project,control (control sera are only spread out when marked in control)",
+)
 @option("-o", "--output-dir", type=ClickPath(exists=False), required=True)
 @option("-b", "--barcodes", type=File("rb"), required=True, help="min cols: plate_well,bc_read")
 @option("-t", "--transfer-mass", type=float, default=2, help="mass to transfer (µg)")
@@ -268,9 +512,26 @@ def cli():
 @option(
     "-M", "--max-volume", type=float, default=100, help="maximum transfer volume (µL)"
 )
-@option("--shuffle-wells", is_flag=True, help="shuffle wells (deterministically)")
+@option(
+    "--shuffle-wells",
+    is_flag=True,
+    help="shuffle wells (deterministically, balancing controls and projects)",
+)
+@option(
+    "--stock-dilution",
+    type=FloatRange(min=1, min_open=True),
+    help="source plate dilution relative to the stock plate used to rescue "
+    "too_dilute wells (e.g., 100 for 1:100)",
+)
 def prepare_phip_normalization(
-    input, output_dir, barcodes, transfer_mass, min_volume, max_volume, shuffle_wells
+    input,
+    output_dir,
+    barcodes,
+    transfer_mass,
+    min_volume,
+    max_volume,
+    shuffle_wells,
+    stock_dilution,
 ):
     """Normalize and shuffle serum samples for PhIP-seq
 
@@ -280,7 +541,8 @@ def prepare_phip_normalization(
     validate_data(df)
     df = compute_normalization(df, transfer_mass, min_volume, max_volume, shuffle_wells)
     df = attach_barcodes(df, barcodes)
-    summary = summarize_output(df)
+    redilution = compute_redilution(df, min_volume, max_volume, stock_dilution)
+    summary = summarize_output(df, redilution)
     summary["invocation"] = " ".join(sys.argv)
 
     output_dir = Path(output_dir)
@@ -299,6 +561,11 @@ def prepare_phip_normalization(
         float_format="%.3f",
     )
 
+    # write plate-normalization-shuffle.parquet
+    write_plate_table(
+        df, output_dir / "plate-normalization-shuffle.parquet", experiment_name
+    )
+
     # write {experiment_name}-sample-sheet.csv
     sample_sheet = create_sample_sheet(df, experiment_name)
     with open(output_dir / f"{experiment_name}-sample-sheet.csv", "w") as op:
@@ -307,6 +574,20 @@ def prepare_phip_normalization(
     # write execute-normalization-shuffle.py
     instantiate_template_protocol(df, output_dir / "execute-normalization-shuffle.py")
 
+    # write plate-redilution.tsv for out-of-range wells, and execute-redilution.py
+    # when any of them can be rescued
+    if len(redilution) > 0:
+        redilution.to_csv(
+            output_dir / "plate-redilution.tsv",
+            sep="\t",
+            index=False,
+            float_format="%.3f",
+        )
+    if (redilution["redil_flag"] == "valid").sum() > 0:
+        instantiate_redilution_protocol(
+            redilution, output_dir / "execute-redilution.py"
+        )
+
     # write plate-viz.html
     fig = draw_plate(df, output_dir)
     plot(
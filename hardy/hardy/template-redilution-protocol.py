@@ -0,0 +1,85 @@
+from opentrons import labware, instruments
+
+from csv import DictReader
+from io import StringIO
+
+
+data = StringIO("""{}""")
+
+
+reader = DictReader(data, dialect="unix", delimiter="\t", strict=True)
+rows = [row for row in reader if row["redil_flag"] == "valid"]
+dilutions = [row for row in rows if float(row["redil_factor"]) > 1]
+parents = set(row["redil_parent"] for row in rows)
+
+
+# labware (plates only when some transfer needs them)
+tiprack50 = labware.load("opentrons-tiprack-300ul", "7")
+tiprack300 = labware.load("opentrons-tiprack-300ul", "8")
+dest_plate = labware.load("96-deep-well", "5")
+parent_plates = {{}}
+if "stock_plate" in parents:
+    parent_plates["stock_plate"] = labware.load("96-flat", "1")
+if "source_plate" in parents:
+    parent_plates["source_plate"] = labware.load("96-flat", "4")
+if len(dilutions) > 0:
+    intermediate_plate = labware.load("96-deep-well", "6")
+    trough = labware.load("trough-12row", "9")
+    diluent = trough.wells("A1")
+
+
+# pipettes
+p50 = instruments.P50_Single(mount="left", tip_racks=[tiprack50])
+p300 = instruments.P300_Single(mount="right", tip_racks=[tiprack300])
+
+
+def pipette_for(volume):
+    return p50 if volume <= 50 else p300
+
+
+# diluent into the intermediate plate (batched, one tip per pipette)
+for pipette in [p50, p300]:
+    batch = [
+        row
+        for row in dilutions
+        if pipette_for(float(row["redil_diluent_vol_ul"])) is pipette
+    ]
+    if len(batch) > 0:
+        pipette.transfer(
+            [float(row["redil_diluent_vol_ul"]) for row in batch],
+            diluent,
+            [intermediate_plate.wells(row["redil_well"]) for row in batch],
+            new_tip="once",
+        )
+
+
+# samples into the diluent
+for row in dilutions:
+    volume = float(row["redil_sample_vol_ul"])
+    total = volume + float(row["redil_diluent_vol_ul"])
+    pipette = pipette_for(volume)
+    pipette.transfer(
+        volume,
+        parent_plates[row["redil_parent"]].wells(row["source_well"]),
+        intermediate_plate.wells(row["redil_well"]),
+        new_tip="always",
+        mix_after=(5, min(total / 2, pipette.max_volume)),
+    )
+
+
+# remaining transfers into the destination plate
+for row in rows:
+    if float(row["redil_factor"]) > 1:
+        source_well = intermediate_plate.wells(row["redil_well"])
+    else:
+        source_well = parent_plates[row["redil_parent"]].wells(row["source_well"])
+    volume = float(row["redil_transfer_vol_ul"])
+
+    pipette = pipette_for(volume)
+    pipette.transfer(
+        volume,
+        source_well,
+        dest_plate.wells(row["dest_well"]),
+        new_tip="always",
+        blow_out=True,
+    )
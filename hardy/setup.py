@@ -13,6 +13,14 @@ setup(
     author="Laserson Lab",
     classifiers=["Programming Language :: Python :: 3"],
     packages=find_packages(),
-    install_requires=["click", "pandas", "plotly", "pyyaml", "sample_sheet"],
+    install_requires=[
+        "click>=8",
+        "numpy",
+        "pandas",
+        "plotly",
+        "pyarrow>=14",
+        "pyyaml",
+        "sample_sheet",
+    ],
     entry_points={"console_scripts": ["hardy = hardy.cli:cli"]},
 )
@@ -97,7 +97,7 @@ import sys
 import os
 from os.path import join as pjoin
 from io import StringIO
-from random import shuffle, seed
+from hashlib import sha256
 from itertools import product
 from textwrap import dedent
 
@@ -144,8 +144,115 @@ def validate_input(df):
         raise ValueError('Each row must have a unique library_id')
 
 
-def set_seed(df):
-    seed(''.join(df['library_id']))
+def layout_seed(df):
+    return int.from_bytes(sha256(''.join(df['library_id']).encode()).digest()[:8], 'big')
+
+
+def is_control(value):
+    # True/1/'true'/'yes' mark a control serum; anything else does not
+    if isinstance(value, str):
+        return value.strip().lower() in ['true', 'yes', '1']
+    return bool(value is True or value == 1)
+
+
+def layout_groups(df):
+    # bead-only controls (no concentrations) and control sera (marked in the
+    # optional control column) are their own groups; the rest are grouped by
+    # project
+    if 'project' in df.columns:
+        groups = df['project'].fillna('sample').astype(str)
+    else:
+        groups = pd.Series('sample', index=df.index)
+    if 'control' in df.columns:
+        groups = groups.where(~df['control'].map(is_control), 'control')
+    beads = df['conc_plate_1_ug_ml'].isnull() & df['conc_plate_2_ug_ml'].isnull()
+    return groups.where(~beads, 'beads')
+
+
+control_groups = ['beads', 'control']
+control_weight = 4.0
+
+
+def expected_group_scores(size):
+    # row/column counts under random placement are hypergeometric, so the
+    # expected squared deviation from an even spread is their variance
+    spread = size * (96 - size) / 95
+    row_imbalance = 8 * spread * (12 / 96) * (84 / 96)
+    col_imbalance = 12 * spread * (8 / 96) * (88 / 96)
+    adjacent_pairs = (8 * 11 + 7 * 12) * size * (size - 1) / (96 * 95)
+    return row_imbalance + col_imbalance + adjacent_pairs
+
+
+def score_layouts(codes, weights, wells):
+    # wells is a (candidates, samples) array of indices into all_wells(); each
+    # group is scored relative to random placement (vs_random < 1 beats a
+    # plain shuffle) and candidates on the weighted sum; lower is better
+    num_candidates = wells.shape[0]
+    num_groups = len(weights)
+    sizes = np.bincount(codes, minlength=num_groups)
+    candidates = np.arange(num_candidates)[:, None]
+
+    def count(keys, num_keys):
+        # occurrences of each (candidate, group, key) for all groups at once
+        flat = ((candidates * num_groups + codes) * num_keys + keys).ravel()
+        counts = np.bincount(flat, minlength=num_candidates * num_groups * num_keys)
+        return counts.reshape(num_candidates, num_groups, num_keys)
+
+    row_imbalance = ((count(wells // 12, 8) - sizes[:, None] / 8) ** 2).sum(axis=2)
+    col_imbalance = ((count(wells % 12, 12) - sizes[:, None] / 12) ** 2).sum(axis=2)
+
+    plate = np.full((num_candidates, 96), -1)
+    plate[candidates, wells] = codes
+    plate = plate.reshape(num_candidates, 8, 12)
+    horizontal = np.where(plate[:, :, 1:] == plate[:, :, :-1], plate[:, :, 1:], -1)
+    vertical = np.where(plate[:, 1:, :] == plate[:, :-1, :], plate[:, 1:, :], -1)
+    pairs = np.concatenate([horizontal.reshape(num_candidates, -1),
+                            vertical.reshape(num_candidates, -1)], axis=1)
+    flat = (np.broadcast_to(candidates, pairs.shape) * num_groups + pairs)[pairs >= 0]
+    adjacent_pairs = np.bincount(
+        flat, minlength=num_candidates * num_groups).reshape(num_candidates, num_groups)
+
+    vs_random = (row_imbalance + col_imbalance + adjacent_pairs) / expected_group_scores(sizes)
+    return {
+        'score': vs_random @ np.asarray(weights, dtype=float),
+        'row_imbalance': row_imbalance,
+        'col_imbalance': col_imbalance,
+        'adjacent_pairs': adjacent_pairs,
+        'vs_random': vs_random}
+
+
+def group_weights(groups):
+    return [control_weight if group in control_groups else 1.0 for group in groups]
+
+
+def constrained_layout(df, num_candidates=16384, shortlist=0.05, chunk_size=1024):
+    # deterministically pick the best-balanced of many random layouts: first
+    # shortlist on the worst group (so every group beats random), then rank on
+    # the weighted score; candidates are scored in chunks to bound memory
+    codes, groups = pd.factorize(layout_groups(df))
+    rng = np.random.default_rng(layout_seed(df))
+    wells = np.argsort(rng.random((num_candidates, 96)), axis=1)[:, :len(df)]
+    weights = group_weights(groups)
+    chunks = [score_layouts(codes, weights, chunk)
+              for chunk in np.array_split(wells, max(1, num_candidates // chunk_size))]
+    score = np.concatenate([chunk['score'] for chunk in chunks])
+    vs_random = np.concatenate([chunk['vs_random'] for chunk in chunks])
+    worst_group = vs_random.max(axis=1, initial=0)
+    shortlisted = worst_group <= np.quantile(worst_group, shortlist)
+    best = np.where(shortlisted, score, np.inf).argmin()
+    return [all_wells()[i] for i in wells[best]]
+
+
+def summarize_layout(df):
+    codes, groups = pd.factorize(layout_groups(df))
+    wells = np.array([[all_wells().index(well) for well in df['dest_well']]])
+    scores = score_layouts(codes, group_weights(groups), wells)
+    per_group = ['row_imbalance', 'col_imbalance', 'adjacent_pairs', 'vs_random']
+    return {
+        'score': scores['score'][0].tolist(),
+        'groups': {
+            group: {name: scores[name][0, code].tolist() for name in per_group}
+            for (code, group) in enumerate(groups)}}
 
 
 def summarize_output(df, min_volume, max_volume):
@@ -172,7 +279,8 @@ def summarize_output(df, min_volume, max_volume):
         'num_too_concentrated': num_too_concentrated,
         'num_empty': num_empty,
         'num_weird': num_weird,
-        'non_valid_wells': flagged_wells}
+        'non_valid_wells': flagged_wells,
+        'layout': summarize_layout(df)}
 
     print('median transfer vol ≈ {:.0f} µL\n'.format(median_transfer_vol), file=sys.stderr)
     print('{} libraries in this plate'.format(num_libraries), file=sys.stderr)
@@ -188,6 +296,19 @@ def summarize_output(df, min_volume, max_volume):
     return summary
 
 
+def write_plate_table(df, output_path, run):
+    # typed columnar copy of the plate table; measurements are stored as floats
+    # and every other column as strings so tables from many runs share a
+    # schema (see hardy.runs)
+    df = df.assign(run=run)
+    for col in df.columns:
+        if col.startswith('conc') or col.startswith('transfer_vol'):
+            df[col] = df[col].astype('float64')
+        else:
+            df[col] = df[col].astype('string')
+    df.to_parquet(output_path, index=False)
+
+
 def draw_plate(df, output_dir):
     from bokeh.plotting import figure, output_file, save, ColumnDataSource as CDS
     from bokeh.palettes import viridis
@@ -245,7 +366,8 @@ def draw_plate(df, output_dir):
 @option('-M', '--max-volume', type=float, default=100,
         help='maximum transfer volume (µL)')
 @option('--shuffle-wells', is_flag=True,
-        help='shuffle wells (deterministically using list of identifiers)')
+        help='shuffle wells (deterministically using list of identifiers, '
+             'balancing controls and projects across rows and columns)')
 def main(input, output_dir, transfer_mass, min_volume, max_volume, shuffle_wells):
     print(dedent("""
                     **************************************
@@ -262,10 +384,7 @@ def main(input, output_dir, transfer_mass, min_volume, max_volume, shuffle_wells
 
     # randomize positions if requested
     if shuffle_wells:
-        set_seed(df)  # ensures deterministic shuffling
-        shuffled_wells = all_wells()
-        shuffle(shuffled_wells)
-        df['dest_well'] = shuffled_wells[:len(df)]
+        df['dest_well'] = constrained_layout(df)  # deterministic
     else:
         df['dest_well'] = df['source_well']
 
@@ -313,6 +432,8 @@ def main(input, output_dir, transfer_mass, min_volume, max_volume, shuffle_wells
     # write out data for robot protocol
     df.to_csv(pjoin(output_dir, 'plate-normalization.tsv'),
               sep='\t', index=False, float_format='%.3f')
+    write_plate_table(df, pjoin(output_dir, 'plate-normalization.parquet'),
+                      os.path.basename(os.path.normpath(output_dir)))
 
     # write python file with data encoded into it
     with open(pjoin(output_dir, 'execute-normalization.py'), 'w') as op: